@@ -1,22 +1,34 @@
 #!/usr/bin/env python3
-import argparse, json, os, math, random, csv
-from collections import defaultdict, Counter
+import argparse, os, math, csv
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from typing import List, Dict, Tuple
 
+import numpy as np
+import pandas as pd
+import orjson
+from scipy.stats import binom
+
+try:
+    from numba import njit, prange, set_num_threads
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 # --------------------------
 # Helpers
 # --------------------------
 
 PUNCT = set(" .,:;!?\"'()[]{}")
+_PUNCT_STR = "".join(PUNCT)
 
+@lru_cache(maxsize=100_000)
 def normalize_span(s: str) -> str:
     if s is None:
         return ""
-    s = s.strip()
     # lower + strip common punctuation at ends + collapse spaces
-    s = s.lower().strip("".join(PUNCT))
-    s = " ".join(s.split())
-    return s
+    return " ".join(s.strip().lower().strip(_PUNCT_STR).split())
 
 def exact_match(ans: str, gold: str) -> int:
     return int(ans == gold)
@@ -25,49 +37,82 @@ def loose_match(ans: str, gold: str) -> int:
     # "loose": case/space/punct normalized
     return int(normalize_span(ans) == normalize_span(gold))
 
-def bootstrap_ci(binary_list: List[int], n_boot: int = 10000, alpha: float = 0.05) -> Tuple[float,float,float]:
-    if not binary_list:
-        return (float('nan'), float('nan'), float('nan'))
-    n = len(binary_list)
-    base = sum(binary_list)/n
+METRICS = ("exact", "loose", "soft", "recall_any")
+
+if HAS_NUMBA:
+    @njit(cache=True, parallel=True)
+    def _boot_kernel(X, n_boot, seed):
+        # X: (n, m) 0/1 columns resampled with the same draws (common random numbers)
+        # splitmix64 stream per draw -> deterministic regardless of thread count
+        n, m = X.shape
+        out = np.empty((n_boot, m), dtype=np.float32)
+        for b in prange(n_boot):
+            state = np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(b)
+            s = np.zeros(m, dtype=np.int64)
+            for _i in range(n):
+                state += np.uint64(0x9E3779B97F4A7C15)
+                z = state
+                z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+                z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+                z = z ^ (z >> np.uint64(31))
+                row = np.int64(z % np.uint64(n))
+                for j in range(m):
+                    s[j] += X[row, j]
+            for j in range(m):
+                out[b, j] = s[j] / n
+        return out
+
+def _limit_numba_threads(n_threads: int):
+    # ProcessPoolExecutor initializer: split the cores across workers instead of
+    # every worker starting a cpu_count-sized numba thread pool
+    if HAS_NUMBA:
+        set_num_threads(max(1, n_threads))
+
+def bootstrap_ci_many(X, n_boot: int = 10000, alpha: float = 0.05) -> List[Tuple[float,float,float]]:
+    """bootstrap_ci for each column of an (n, m) 0/1 matrix, sharing one set of resamples."""
+    X = np.asarray(X, dtype=np.uint8)
+    n, m = X.shape
     if n == 0:
-        return (float('nan'), float('nan'), float('nan'))
-    # fast vectorless bootstrap
-    rng = random.Random(17)
-    stats = []
-    for _ in range(n_boot):
-        s = 0
-        for _i in range(n):
-            s += binary_list[rng.randrange(n)]
-        stats.append(s/n)
-    stats.sort()
-    lo = stats[int((alpha/2)*n_boot)]
-    hi = stats[int((1-alpha/2)*n_boot)]
-    return (base, lo, hi)
-
-def mcnemar(a_correct: List[int], b_correct: List[int]) -> Tuple[int,int,float]:
+        return [(float('nan'), float('nan'), float('nan'))] * m
+    base = X.sum(axis=0, dtype=np.int64) / n
+    if HAS_NUMBA:
+        # JIT kernel (compiled once, cached on disk across CLI runs)
+        stats = _boot_kernel(np.ascontiguousarray(X), n_boot, 17)
+    else:
+        # vectorized bootstrap: multinomial resample counts, means = counts @ X / n
+        rng = np.random.default_rng(17)
+        counts = rng.multinomial(n, np.full(n, 1.0/n), size=n_boot)
+        stats = counts @ X / n
+    # only two order statistics are needed -> introselect instead of a full sort
+    lo_i, hi_i = int((alpha/2)*n_boot), int((1-alpha/2)*n_boot)
+    part = np.partition(stats, [lo_i, hi_i], axis=0)
+    lo = part[lo_i]
+    hi = part[hi_i]
+    return [(float(base[j]), float(lo[j]), float(hi[j])) for j in range(m)]
+
+def bootstrap_ci(binary_list, n_boot: int = 10000, alpha: float = 0.05) -> Tuple[float,float,float]:
+    return bootstrap_ci_many(np.asarray(binary_list, dtype=np.uint8).reshape(-1, 1), n_boot, alpha)[0]
+
+def mcnemar(a_correct, b_correct) -> Tuple[int,int,float]:
     """
-    Exact binomial McNemar (no continuity corr) on paired 0/1 lists.
+    Exact binomial McNemar (no continuity corr) on paired 0/1 lists or bool arrays.
     Returns (b01, b10, p_value) where:
       b01: A wrong, B right
       b10: A right, B wrong
     """
     if len(a_correct) != len(b_correct):
         raise ValueError("Lists must be the same length for McNemar.")
-    b01 = b10 = 0
-    for ac, bc in zip(a_correct, b_correct):
-        if ac == 0 and bc == 1: b01 += 1
-        elif ac == 1 and bc == 0: b10 += 1
+    a = np.asarray(a_correct, dtype=bool)
+    b = np.asarray(b_correct, dtype=bool)
+    b01 = int(np.count_nonzero(~a & b))
+    b10 = int(np.count_nonzero(a & ~b))
     n = b01 + b10
     if n == 0:
         return b01, b10, 1.0
     # exact binomial two-sided p = 2*min(Bin(k; n, 0.5), 1 - Bin(k-1; n, 0.5))
     # compute tail at min(b01,b10)
     k = min(b01, b10)
-    from math import comb
-    tail = sum(comb(n, i) for i in range(0, k+1)) / (2**n)
-    p = 2*tail
-    p = min(1.0, p)
+    p = min(1.0, 2*float(binom.cdf(k, n, 0.5)))
     return b01, b10, p
 
 # --------------------------
@@ -75,66 +120,75 @@ def mcnemar(a_correct: List[int], b_correct: List[int]) -> Tuple[int,int,float]:
 # --------------------------
 
 def load_jsonl(path: str) -> List[dict]:
-    rows = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line: continue
-            rows.append(json.loads(line))
-    return rows
-
-def summarize_run(rows: List[dict], label_field: str = "label") -> dict:
-    exact = []
-    loose = []
-    soft  = []   # label == 'supported'
-    recall_any = []  # proxy for retriever Recall@k: did any passage contain gold?
-    domains = defaultdict(lambda: {"exact": [], "loose": [], "soft": [], "recall": []})
+    # binary mode: orjson decodes UTF-8 itself and tolerates the trailing newline
+    with open(path, "rb") as f:
+        return [orjson.loads(line) for line in f if line.strip()]
 
-    for r in rows:
-        gold = r.get("gold_answer","")
-        ans  = r.get("answer","")
-        lab  = (r.get(label_field) or "").lower()
-        exact.append(exact_match(ans, gold))
-        loose.append(loose_match(ans, gold))
-        soft.append(int(lab == "supported"))
-        recall_any.append(int(r.get("supported_gold_in_evidence", 0) == 1))
-
-        d = r.get("domain", "unknown")
-        domains[d]["exact"].append(exact[-1])
-        domains[d]["loose"].append(loose[-1])
-        domains[d]["soft"].append(soft[-1])
-        domains[d]["recall"].append(recall_any[-1])
-
-    def pack(xs):
-        mean, lo, hi = bootstrap_ci(xs)
-        return {"mean": round(mean,3), "ci95": [round(lo,3), round(hi,3)], "n": len(xs)}
+# Per-row fields used by the summaries, projected once after loading
+Row = namedtuple("Row", "id gold answer label domain supported_gold")
 
+def project_rows(raw: List[dict], label_field: str = "label") -> List[Row]:
+    return [
+        Row(r.get("id"), r.get("gold_answer",""), r.get("answer",""),
+            (r.get(label_field) or "").lower(), r.get("domain", "unknown"),
+            int(r.get("supported_gold_in_evidence", 0) == 1))
+        for r in raw
+    ]
+
+def summarize_run(rows: List[Row]) -> dict:
+    # 0/1 outcome columns stored as uint8, filled in place
+    n_rows = len(rows)
+    exact = np.zeros(n_rows, dtype=np.uint8)
+    loose = np.zeros(n_rows, dtype=np.uint8)
+    soft  = np.zeros(n_rows, dtype=np.uint8)   # label == 'supported'
+    recall_any = np.zeros(n_rows, dtype=np.uint8)  # proxy for retriever Recall@k: did any passage contain gold?
+    domain = [None] * n_rows
+    lab_counts = Counter()
+
+    for i, r in enumerate(rows):
+        lab_counts[r.label] += 1
+        exact[i] = exact_match(r.answer, r.gold)
+        loose[i] = loose_match(r.answer, r.gold)
+        soft[i] = r.label == "supported"
+        recall_any[i] = r.supported_gold
+        domain[i] = r.domain
+
+    def pack(X):
+        # one shared resample set for all metrics of this row set
+        out = {}
+        for name, (mean, lo, hi) in zip(METRICS, bootstrap_ci_many(X)):
+            out[name] = {"mean": round(mean,3), "ci95": [round(lo,3), round(hi,3)], "n": len(X)}
+        return out
+
+    # columnar per-domain split; sort=False keeps first-seen domain order
+    df = pd.DataFrame({"domain": domain, "exact": exact, "loose": loose, "soft": soft, "recall_any": recall_any})
     per_domain = {}
-    for d, dd in domains.items():
-        per_domain[d] = {
-            "exact": pack(dd["exact"]),
-            "loose": pack(dd["loose"]),
-            "soft":  pack(dd["soft"]),
-            "recall_any": pack(dd["recall"]),
-            "n": len(dd["exact"]),
-        }
+    for d, g in df.groupby("domain", sort=False, dropna=False):
+        # pandas keys a null domain as nan; restore None so the CSV cell stays empty
+        per_domain[None if pd.isna(d) else d] = {**pack(g[list(METRICS)].to_numpy()), "n": len(g)}
 
     overall = {
-        "exact": pack(exact),
-        "loose": pack(loose),
-        "soft":  pack(soft),
-        "recall_any": pack(recall_any),
+        **pack(np.column_stack([exact, loose, soft, recall_any])),
         "n": len(rows),
-        "label_counts": dict(Counter([(r.get(label_field) or "").lower() for r in rows]))
+        "label_counts": dict(lab_counts)
     }
     return {"overall": overall, "by_domain": per_domain}
 
-def index_by_id(rows: List[dict]) -> Dict[int, dict]:
+def index_by_id(rows: List[Row]) -> Dict[int, Row]:
     out = {}
     for r in rows:
-        out[int(r["id"])] = r
+        out[int(r.id)] = r
     return out
 
+def model_columns(rows: List[Row]) -> Dict[str, np.ndarray]:
+    """Per-model id/exact/soft columns for pairwise tests (ids unique, last row wins)."""
+    idx = index_by_id(rows)
+    return {
+        "ids":   np.fromiter(idx.keys(), dtype=np.int64, count=len(idx)),
+        "exact": np.array([exact_match(r.answer, r.gold) for r in idx.values()], dtype=bool),
+        "soft":  np.array([r.label == "supported" for r in idx.values()], dtype=bool),
+    }
+
 # --------------------------
 # Main
 # --------------------------
@@ -149,12 +203,23 @@ def main():
 
     os.makedirs(args.outdir, exist_ok=True)
 
-    runs = []
+    loaded = []
     for p in args.models:
-        rows = load_jsonl(p)
+        raw = load_jsonl(p)
         # name: try to get from first row's 'model' or filename
-        name = rows[0].get("model") if rows and rows[0].get("model") else os.path.splitext(os.path.basename(p))[0]
-        runs.append((name, rows, p))
+        name = raw[0].get("model") if raw and raw[0].get("model") else os.path.splitext(os.path.basename(p))[0]
+        loaded.append((name, project_rows(raw), p))
+
+    # models are independent -> summarize (bootstrap-heavy) in parallel
+    all_rows = [rows for _, rows, _ in loaded]
+    if len(all_rows) > 1:
+        workers = min(len(all_rows), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_limit_numba_threads,
+                                 initargs=((os.cpu_count() or 1) // workers,)) as ex:
+            summaries = list(ex.map(summarize_run, all_rows))
+    else:
+        summaries = [summarize_run(rows) for rows in all_rows]
+    runs = [(name, rows, p, summ) for (name, rows, p), summ in zip(loaded, summaries)]
 
     # Per-model summaries
     per_model_csv = os.path.join(args.outdir, "per_model_summary.csv")
@@ -166,8 +231,7 @@ def main():
                     "soft_mean","soft_lo","soft_hi",
                     "recall_mean","recall_lo","recall_hi",
                     "labels_supported","labels_contradicted","labels_unverifiable"])
-        for name, rows, _ in runs:
-            summ = summarize_run(rows)
+        for name, _, _, summ in runs:
             ov = summ["overall"]
             lab = ov["label_counts"]
             w.writerow([
@@ -188,8 +252,7 @@ def main():
                     "loose_mean","loose_lo","loose_hi",
                     "soft_mean","soft_lo","soft_hi",
                     "recall_mean","recall_lo","recall_hi"])
-        for name, rows, _ in runs:
-            summ = summarize_run(rows)
+        for name, _, _, summ in runs:
             for dom, dv in summ["by_domain"].items():
                 w.writerow([
                     name, dom, dv["n"],
@@ -208,26 +271,24 @@ def main():
         with open(pair_csv, "w", newline="", encoding="utf-8") as f:
             w = csv.writer(f)
             w.writerow(["model_A","model_B","metric","n_shared","A_wrong_B_right","A_right_B_wrong","p_value"])
+            # normalize each model once; pairs below are pure array ops
+            per_model = [model_columns(rows) for _, rows, _, _ in runs]
             for i in range(len(runs)):
                 for j in range(i+1, len(runs)):
-                    nameA, rowsA, _ = runs[i]
-                    nameB, rowsB, _ = runs[j]
-                    idxA = index_by_id(rowsA)
-                    idxB = index_by_id(rowsB)
-                    shared_ids = sorted(set(idxA.keys()) & set(idxB.keys()))
-                    if not shared_ids:
+                    nameA = runs[i][0]
+                    nameB = runs[j][0]
+                    colA, colB = per_model[i], per_model[j]
+                    shared_ids, ia, ib = np.intersect1d(colA["ids"], colB["ids"],
+                                                      assume_unique=True, return_indices=True)
+                    if not shared_ids.size:
                         continue
 
                     # EXACT
-                    a_exact = [exact_match(idxA[k]["answer"], idxA[k]["gold_answer"]) for k in shared_ids]
-                    b_exact = [exact_match(idxB[k]["answer"], idxB[k]["gold_answer"]) for k in shared_ids]
-                    b01, b10, p = mcnemar(a_exact, b_exact)
+                    b01, b10, p = mcnemar(colA["exact"][ia], colB["exact"][ib])
                     w.writerow([nameA, nameB, "exact", len(shared_ids), b01, b10, round(p,6)])
 
                     # SOFT (supported)
-                    a_soft = [int((idxA[k].get("label","").lower()) == "supported") for k in shared_ids]
-                    b_soft = [int((idxB[k].get("label","").lower()) == "supported") for k in shared_ids]
-                    b01, b10, p = mcnemar(a_soft, b_soft)
+                    b01, b10, p = mcnemar(colA["soft"][ia], colB["soft"][ib])
                     w.writerow([nameA, nameB, "soft", len(shared_ids), b01, b10, round(p,6)])
 
         print(f"[ok] wrote: {pair_csv}")
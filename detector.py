@@ -1,8 +1,12 @@
 from __future__ import annotations
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from functools import lru_cache
-import os, re, json, hashlib
+import os, re, hashlib, sqlite3, asyncio, threading
+from collections import OrderedDict
 
+import aiohttp
+import orjson
+import torch
 import wikipedia
 from transformers import pipeline
 
@@ -17,6 +21,13 @@ NLI_MODEL_ID = os.getenv("NLI_MODEL_ID", "typeform/distilbert-base-uncased-mnli"
 WIKI_SENTENCES = int(os.getenv("WIKI_SENTENCES", "3"))
 WIKI_RESULTS_PER_QUERY = int(os.getenv("WIKI_RESULTS_PER_QUERY", "2"))
 USE_CLAIMIFY = True  # set False to behave like pre-change baseline
+# Half precision for NLI on GPU; CPU stays FP32. torch.compile is opt-in: batches are
+# dynamically padded, so per-shape compiles cost more than they save on short runs
+NLI_COMPILE = os.getenv("NLI_COMPILE", "0") == "1"
+if torch.cuda.is_available():
+    NLI_DTYPE = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+else:
+    NLI_DTYPE = torch.float32
 
 # =========================
 # Small helpers
@@ -29,58 +40,91 @@ def _first_sentences(txt: str, n_sentences: int = 5) -> str:
     parts = re.split(r"(?<=[.!?])\s+", txt.strip())
     return " ".join(parts[:max(1, n_sentences)])
 
+# Question-prefix -> hypothesis template; alternation order is the precedence order
+_CLAIM_RE = re.compile(
+    r"(?P<whowrote>who wrote)|(?P<who>who )|(?P<when>.*what year|when )"
+    r"|(?P<where>where )|(?P<whatis>what (?:is|was))|(?P<which>which )",
+    re.DOTALL,
+)
+_CLAIM_TEMPLATES = {
+    "whowrote": "{a} wrote the work.",
+    "who":      "{a} is the person in question.",
+    "when":     "It happened in {a}.",
+    "where":    "It happened in {a}.",
+    "whatis":   "It is {a}.",
+    "which":    "It is {a}.",
+}
+
 def claimify(question: str, answer: str) -> str:
     """Turn (Q, span-answer) into a declarative hypothesis for NLI."""
     q = (question or "").strip().lower()
     a = (answer or "").strip()
     if not a:
         return "The answer is unknown."
-    if q.startswith("who wrote"):
-        return f"{a} wrote the work."
-    if q.startswith("who "):
-        return f"{a} is the person in question."
-    if "what year" in q or q.startswith("when "):
-        return f"It happened in {a}."
-    if q.startswith("where "):
-        return f"It happened in {a}."
-    if q.startswith(("what is", "what was")):
-        return f"It is {a}."
-    if q.startswith("which "):
-        return f"It is {a}."
+    m = _CLAIM_RE.match(q)
+    if m:
+        return _CLAIM_TEMPLATES[m.lastgroup].format(a=a)
     # fallback
     return f"Answer: {a}"
 
+_WS_RE = re.compile(r"\s+")
+
+@lru_cache(maxsize=65536)
+def _norm_answer(answer: str) -> str:
+    return _WS_RE.sub(" ", (answer or "").strip().lower())
+
+@lru_cache(maxsize=65536)
+def _lower_cached(text: str) -> str:
+    return text.lower()
+
+def _snip_lower(s: Dict) -> str:
+    # lowercased text memoized by content (snippets are reused across candidates);
+    # kept off the snippet dicts, which are returned to callers as verdict["evidence"]
+    return _lower_cached(s.get("text", ""))
+
 def _span_support(answer: str, snippets: List[Dict]) -> bool:
     """Fast-path: if short span (<=3 tokens) appears in any snippet, count supported."""
-    a = re.sub(r"\s+", " ", (answer or "").strip().lower())
+    a = _norm_answer(answer)
     if not a or len(a.split()) > 3:
         return False
     for s in snippets or []:
-        if a in (s.get("text", "").lower()):
+        if a in _snip_lower(s):
             return True
     return False
 
 # =========================
 # Evidence: disk cache
 # =========================
-EVID_CACHE_PATH = "runs/evidence_cache.json"
+EVID_CACHE_PATH = "runs/evid_cache.db"
+EVID_LEGACY_PATH = "runs/evidence_cache.json"   # pre-SQLite cache, imported once
 os.makedirs("runs", exist_ok=True)
-try:
-    _EVID_CACHE = json.load(open(EVID_CACHE_PATH, "r", encoding="utf-8"))
-except Exception:
-    _EVID_CACHE = {}
+_EVID_DB = sqlite3.connect(EVID_CACHE_PATH, check_same_thread=False)
+_EVID_LOCK = threading.Lock()   # retrieve_evidence may run on worker threads
+_EVID_DB.execute("PRAGMA journal_mode=WAL")
+_EVID_DB.execute("CREATE TABLE IF NOT EXISTS e(k TEXT PRIMARY KEY, v BLOB)")
+if not _EVID_DB.execute("SELECT 1 FROM e LIMIT 1").fetchone():
+    try:
+        with open(EVID_LEGACY_PATH, "rb") as f:
+            _legacy = orjson.loads(f.read())
+        _EVID_DB.executemany("INSERT OR IGNORE INTO e VALUES(?,?)",
+                             [(k, orjson.dumps(v)) for k, v in _legacy.items()])
+        _EVID_DB.commit()
+    except Exception:
+        pass
 
 def _evid_key(question: str, answer: str, k: int) -> str:
     return hashlib.sha1(f"{question}::{answer}::k={k}".encode()).hexdigest()
 
 def _evid_get(q: str, a: str, k: int):
-    return _EVID_CACHE.get(_evid_key(q, a, k))
+    with _EVID_LOCK:
+        row = _EVID_DB.execute("SELECT v FROM e WHERE k=?", (_evid_key(q, a, k),)).fetchone()
+    return orjson.loads(row[0]) if row else None
 
 def _evid_put(q: str, a: str, k: int, val):
-    _EVID_CACHE[_evid_key(q, a, k)] = val
     try:
-        with open(EVID_CACHE_PATH, "w", encoding="utf-8") as f:
-            json.dump(_EVID_CACHE, f)
+        with _EVID_LOCK:
+            _EVID_DB.execute("INSERT OR REPLACE INTO e VALUES(?,?)", (_evid_key(q, a, k), orjson.dumps(val)))
+            _EVID_DB.commit()
     except Exception:
         pass
 
@@ -94,13 +138,75 @@ def _search_titles(query: str, n: int) -> List[str]:
     except Exception:
         return []
 
-@lru_cache(maxsize=512)
-def _wiki_summary(title: str, sentences: int) -> str:
+WIKI_API_URL = "https://en.wikipedia.org/w/api.php"
+WIKI_BATCH = 20  # TextExtracts returns at most 20 intro extracts per request
+
+async def _fetch_batch(session: aiohttp.ClientSession, titles: List[str]) -> Dict[str, str]:
+    """One MediaWiki query for up to WIKI_BATCH intro extracts; keyed by the requested title."""
+    params = {
+        "action": "query", "format": "json", "formatversion": 2, "redirects": 1,
+        "prop": "extracts|pageprops", "ppprop": "disambiguation",
+        "exintro": 1, "explaintext": 1, "exlimit": "max",
+        "titles": "|".join(titles),
+    }
     try:
-        summ = wikipedia.summary(title, sentences=sentences, auto_suggest=False)
-        return _clean_text(summ)
+        async with session.get(WIKI_API_URL, params=params) as r:
+            data = await r.json()
     except Exception:
-        return ""
+        return {}
+    query = data.get("query", {})
+    # follow title normalization + redirects back to the title we asked for
+    alias = {t: t for t in titles}
+    for m in query.get("normalized", []) + query.get("redirects", []):
+        for src, dst in list(alias.items()):
+            if dst == m.get("from"):
+                alias[src] = m.get("to")
+    pages = {}
+    for pg in query.get("pages", []):
+        if pg.get("missing") or "disambiguation" in pg.get("pageprops", {}):
+            continue
+        pages[pg.get("title")] = pg.get("extract") or ""
+    return {t: pages.get(dst, "") for t, dst in alias.items()}
+
+async def _fetch_all(titles: List[str]) -> Dict[str, str]:
+    headers = {"User-Agent": "truth-layer/0.1 (evidence retrieval)"}
+    timeout = aiohttp.ClientTimeout(total=20)
+    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
+        chunks = [titles[i:i+WIKI_BATCH] for i in range(0, len(titles), WIKI_BATCH)]
+        out: Dict[str, str] = {}
+        for part in await asyncio.gather(*(_fetch_batch(session, c) for c in chunks)):
+            out.update(part)
+        return out
+
+# per-title LRU of intro extracts: rows share titles far more often than whole title sets
+WIKI_MEMO_SIZE = 4096
+_EXTRACTS: "OrderedDict[str, str]" = OrderedDict()
+_EXTRACTS_LOCK = threading.Lock()   # retrieve_evidence may run on worker threads
+
+def _wiki_summaries(titles: Tuple[str, ...], sentences: int) -> Dict[str, str]:
+    """Short summaries for many titles; only titles not yet memoized go out, in one round-trip.
+    Missing/disambiguation -> ''."""
+    extracts: Dict[str, str] = {}
+    with _EXTRACTS_LOCK:
+        for t in titles:
+            if t in _EXTRACTS:
+                _EXTRACTS.move_to_end(t)
+                extracts[t] = _EXTRACTS[t]
+    misses = [t for t in titles if t not in extracts]
+    if misses:
+        try:
+            fetched = asyncio.run(_fetch_all(misses))
+        except Exception:
+            fetched = {}
+        # titles absent from the reply belong to a failed batch: leave them unmemoized
+        with _EXTRACTS_LOCK:
+            for t, txt in fetched.items():
+                _EXTRACTS[t] = txt
+                _EXTRACTS.move_to_end(t)
+            while len(_EXTRACTS) > WIKI_MEMO_SIZE:
+                _EXTRACTS.popitem(last=False)
+        extracts.update(fetched)
+    return {t: _clean_text(_first_sentences(extracts.get(t, ""), sentences)) for t in titles}
 
 def retrieve_evidence(question: str, answer: str, k: int = 3) -> List[Dict]:
     """Search Q and A surface forms, fetch short wiki summaries, dedupe, cache."""
@@ -112,16 +218,19 @@ def retrieve_evidence(question: str, answer: str, k: int = 3) -> List[Dict]:
     out: List[Dict] = []
     seen_txt = set()
 
-    for q in queries:
+    titles_per_query = [_search_titles(q, n=WIKI_RESULTS_PER_QUERY) for q in queries]
+    all_titles = tuple(dict.fromkeys(t for ts in titles_per_query for t in ts))
+    summaries = _wiki_summaries(all_titles, WIKI_SENTENCES)
+
+    for titles in titles_per_query:
         if len(out) >= k:
             break
-        for title in _search_titles(q, n=WIKI_RESULTS_PER_QUERY):
+        for title in titles:
             if len(out) >= k:
                 break
-            snip = _wiki_summary(title, sentences=WIKI_SENTENCES)
+            snip = summaries.get(title, "")
             if not snip:
                 continue
-            snip = _clean_text(snip)
             if snip in seen_txt:
                 continue
             out.append({"source": "wikipedia", "title": title, "text": snip})
@@ -131,6 +240,41 @@ def retrieve_evidence(question: str, answer: str, k: int = 3) -> List[Dict]:
     _evid_put(question, answer, k, out)
     return out
 
+# =========================
+# NLI: disk cache (content-addressed)
+# =========================
+NLI_CACHE_PATH = "runs/nli_cache.db"
+_NLI_DB = sqlite3.connect(NLI_CACHE_PATH, check_same_thread=False)
+_NLI_LOCK = threading.Lock()   # best_verdict may run on Streamlit script threads
+_NLI_DB.execute("PRAGMA journal_mode=WAL")
+_NLI_DB.execute("CREATE TABLE IF NOT EXISTS c(k BLOB PRIMARY KEY, e REAL, n REAL, co REAL)")
+
+def _nli_key(premise: str, hypothesis: str) -> bytes:
+    # model id is part of the key so switching NLI_MODEL_ID never reuses stale scores
+    return hashlib.sha1(f"{NLI_MODEL_ID}::{premise}|{hypothesis}".encode()).digest()
+
+def _nli_get_many(keys: List[bytes]) -> Dict[bytes, Dict]:
+    out = {}
+    for i in range(0, len(keys), 500):   # stay under SQLite's bound-variable limit
+        chunk = keys[i:i+500]
+        marks = ",".join("?" * len(chunk))
+        with _NLI_LOCK:
+            rows = _NLI_DB.execute(f"SELECT k, e, n, co FROM c WHERE k IN ({marks})", chunk).fetchall()
+        for k, e, n, co in rows:
+            out[k] = {"entail": e, "neutral": n, "contradict": co}
+    return out
+
+def _nli_put_many(items: Dict[bytes, Dict]):
+    try:
+        with _NLI_LOCK:
+            _NLI_DB.executemany(
+                "INSERT OR IGNORE INTO c VALUES(?,?,?,?)",
+                [(k, sc["entail"], sc["neutral"], sc["contradict"]) for k, sc in items.items()],
+            )
+            _NLI_DB.commit()
+    except Exception:
+        pass
+
 # =========================
 # NLI verifier 
 # =========================
@@ -139,7 +283,10 @@ _nli = pipeline(
     model=NLI_MODEL_ID,
     return_all_scores=True,   # we keep both entail & contradict
     device_map="auto",
+    torch_dtype=NLI_DTYPE,
 )
+if NLI_COMPILE and torch.cuda.is_available():
+    _nli.model = torch.compile(_nli.model, dynamic=True)   # one graph across sequence lengths
 
 def _normalize_scores(res) -> Dict[str, float]:
     # Normalize dict | [dict] | [[dict,...]] -> {"entail","neutral","contradict"}
@@ -159,30 +306,55 @@ def _normalize_scores(res) -> Dict[str, float]:
     return {"entail": out["entailment"], "neutral": out["neutral"], "contradict": out["contradiction"]}
 
 def _nli_batch(premises: List[str], hypothesis: str) -> List[Dict]:
-    inputs = [{"text": p, "text_pair": hypothesis} for p in premises]
-    results = _nli(inputs)  # batched by HF
-    return [_normalize_scores(r) for r in results]
+    return _nli_pairs([(p, hypothesis) for p in premises])
 
 def nli_pair(premise: str, hypothesis: str) -> Dict:
     # Kept for API compatibility; used in some UIs
     return _normalize_scores(_nli({"text": premise, "text_pair": hypothesis}))
 
-def best_verdict(question: str, answer: str, snippets: List[Dict], tau: float = 0.60) -> Dict:
-    """Verdict from max entail vs max contradict across snippets."""
+def _nli_pairs(pairs: List[Tuple[str, str]], batch_size: int = 64) -> List[Dict]:
+    """Score many (premise, hypothesis) pairs in one pipeline call, length-bucketed and disk-cached."""
+    if not pairs:
+        return []
+    keys = [_nli_key(p, h) for p, h in pairs]
+    scores = _nli_get_many(list(set(keys)))
+
+    # infer each uncached pair once
+    todo = {}
+    for k, pair in zip(keys, pairs):
+        if k not in scores and k not in todo:
+            todo[k] = pair
+    if todo:
+        miss_keys = list(todo)
+        # sort by length so each padded batch holds similar-sized inputs
+        miss_keys.sort(key=lambda k: len(todo[k][0]) + len(todo[k][1]))
+        inputs = [{"text": todo[k][0], "text_pair": todo[k][1]} for k in miss_keys]
+        with torch.inference_mode():
+            results = _nli(inputs, batch_size=batch_size, truncation=True)
+        fresh = {k: _normalize_scores(r) for k, r in zip(miss_keys, results)}
+        _nli_put_many(fresh)
+        scores.update(fresh)
+
+    return [scores[k] for k in keys]
+
+def _unverifiable() -> Dict:
+    return {"label": "unverifiable", "confidence": 0.0, "max_entail": 0.0, "max_contradict": 0.0, "evidence": None}
+
+def _pre_verdict(answer: str, snippets: List[Dict]):
+    """Verdicts decided without NLI; returns (verdict | None, premises)."""
     if not snippets:
-        return {"label": "unverifiable", "confidence": 0.0, "max_entail": 0.0, "max_contradict": 0.0, "evidence": None}
+        return _unverifiable(), []
 
     # Short-span fast path: if the span literally appears in evidence, treat as supported.
     if _span_support(answer, snippets):
-        return {"label": "supported", "confidence": 0.7, "max_entail": 0.7, "max_contradict": 0.0, "evidence": snippets[0]}
+        return {"label": "supported", "confidence": 0.7, "max_entail": 0.7, "max_contradict": 0.0, "evidence": snippets[0]}, []
 
     premises = [s.get("text", "") for s in snippets if s.get("text")]
     if not premises:
-        return {"label": "unverifiable", "confidence": 0.0, "max_entail": 0.0, "max_contradict": 0.0, "evidence": None}
-
-    hypothesis = claimify(question, answer) if USE_CLAIMIFY else answer
-    results = _nli_batch(premises, hypothesis)
+        return _unverifiable(), []
+    return None, premises
 
+def _verdict_from_scores(snippets: List[Dict], results: List[Dict], tau: float) -> Dict:
     max_ent, max_con, best_idx = 0.0, 0.0, -1
     for i, sc in enumerate(results):
         ent = sc.get("entail", 0.0)
@@ -207,3 +379,33 @@ def best_verdict(question: str, answer: str, snippets: List[Dict], tau: float =
         "max_contradict": round(max_con, 3),
         "evidence": snippets[best_idx] if best_idx != -1 else None,
     }
+
+def best_verdict(question: str, answer: str, snippets: List[Dict], tau: float = 0.60) -> Dict:
+    """Verdict from max entail vs max contradict across snippets."""
+    verdict, premises = _pre_verdict(answer, snippets)
+    if verdict is not None:
+        return verdict
+
+    hypothesis = claimify(question, answer) if USE_CLAIMIFY else answer
+    results = _nli_batch(premises, hypothesis)
+    return _verdict_from_scores(snippets, results, tau)
+
+def best_verdict_many(questions: List[str], answers: List[str], snippets_per_row: List[List[Dict]],
+                      tau: float = 0.60, batch_size: int = 64) -> List[Dict]:
+    """best_verdict over many rows, with every row's NLI pairs flattened into one batched call."""
+    verdicts: List[Dict] = [{}] * len(questions)
+    pairs: List[Tuple[str, str]] = []
+    spans: List[Tuple[int, int, int]] = []   # (row, start, end) into pairs
+    for r, (q, a, snips) in enumerate(zip(questions, answers, snippets_per_row)):
+        verdict, premises = _pre_verdict(a, snips)
+        if verdict is not None:
+            verdicts[r] = verdict
+            continue
+        hypothesis = claimify(q, a) if USE_CLAIMIFY else a
+        spans.append((r, len(pairs), len(pairs) + len(premises)))
+        pairs.extend((p, hypothesis) for p in premises)
+
+    results = _nli_pairs(pairs, batch_size=batch_size)
+    for r, lo, hi in spans:
+        verdicts[r] = _verdict_from_scores(snippets_per_row[r], results[lo:hi], tau)
+    return verdicts
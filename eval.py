@@ -1,64 +1,175 @@
-import os, json, time, argparse, csv, re, hashlib
+import os, json, time, argparse, csv, re, hashlib, atexit
+from itertools import islice
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
-from models import generate_answer, MODEL_ID
-from detector import retrieve_evidence, best_verdict  # NOTE: new signature: best_verdict(question, answer, evid)
+import numpy as np
+import orjson
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+from models import generate_answers, MODEL_ID, MODEL_BACKEND
+from detector import retrieve_evidence, best_verdict_many  # batched best_verdict(question, answer, evid)
 
 # ---------- Text utils ----------
+_WS = re.compile(r"\s+")
+
 def normalize_text(s: str) -> str:
-    s = (s or "").strip().lower()
-    return re.sub(r"\s+", " ", s)
+    return _WS.sub(" ", (s or "").strip().lower())
 
-def token_f1(pred: str, gold: str) -> float:
-    ps = normalize_text(pred).split()
-    gs = normalize_text(gold).split()
-    if not ps or not gs:
+@lru_cache(maxsize=65536)
+def _norm_text_cached(text: str) -> str:
+    return normalize_text(text)
+
+def _snippet_norm(s: dict) -> str:
+    # text-keyed LRU only: snippet dicts are shared with the verdicts and must stay unmodified
+    return _norm_text_cached(s.get("text", ""))
+
+def token_f1_pre(p_ctr: Counter, g_ctr: Counter, lp: int, lg: int) -> float:
+    """token_f1 on pre-built token Counters and token counts."""
+    if not lp or not lg:
         return 0.0
-    from collections import Counter
-    pset, gset = Counter(ps), Counter(gs)
-    overlap = sum((pset & gset).values())
+    # multiset overlap without building a third Counter; iterate the smaller side
+    if len(p_ctr) > len(g_ctr):
+        p_ctr, g_ctr = g_ctr, p_ctr
+    overlap = 0
+    gget = g_ctr.get
+    for tok, v in p_ctr.items():
+        gv = gget(tok)
+        if gv:
+            overlap += v if v < gv else gv
     if overlap == 0:
         return 0.0
-    precision = overlap / max(1, len(ps))
-    recall    = overlap / max(1, len(gs))
-    return 2 * precision * recall / max(precision + recall, 1e-9)
+    precision = overlap / lp
+    recall    = overlap / lg
+    return 2 * precision * recall / (precision + recall)
 
-def loose_correct(pred: str, gold: str, thresh: float = 0.6) -> bool:
-    # exact match, substring, or token-F1 above threshold
-    p, g = normalize_text(pred), normalize_text(gold)
-    if p == g:
+def token_f1(pred: str, gold: str) -> float:
+    ps = normalize_text(pred).split()
+    gs = normalize_text(gold).split()
+    return token_f1_pre(Counter(ps), Counter(gs), len(ps), len(gs))
+
+if HAS_NUMBA:
+    @njit(cache=True)
+    def _f1_batch(p_ids, p_off, g_ids, g_off):
+        # per row: merge two sorted token-id runs -> multiset overlap -> F1
+        n = p_off.size - 1
+        out = np.zeros(n)
+        for r in range(n):
+            i, i_end = p_off[r], p_off[r + 1]
+            j, j_end = g_off[r], g_off[r + 1]
+            lp, lg = i_end - i, j_end - j
+            if lp == 0 or lg == 0:
+                continue
+            overlap = 0
+            while i < i_end and j < j_end:
+                if p_ids[i] == g_ids[j]:
+                    overlap += 1
+                    i += 1
+                    j += 1
+                elif p_ids[i] < g_ids[j]:
+                    i += 1
+                else:
+                    j += 1
+            if overlap:
+                precision = overlap / lp
+                recall = overlap / lg
+                out[r] = 2 * precision * recall / (precision + recall)
+        return out
+
+def token_f1_many(pairs) -> list:
+    """token-F1 for many (pred_tokens, gold_tokens) pairs in one pass (JIT kernel when numba is available)."""
+    if not HAS_NUMBA:
+        return [token_f1_pre(Counter(p), Counter(g), len(p), len(g)) for p, g in pairs]
+    vocab = {}
+    p_ids, g_ids, p_off, g_off = [], [], [0], [0]
+    for p, g in pairs:
+        p_ids.extend(sorted(vocab.setdefault(t, len(vocab)) for t in p))
+        g_ids.extend(sorted(vocab.setdefault(t, len(vocab)) for t in g))
+        p_off.append(len(p_ids))
+        g_off.append(len(g_ids))
+    return _f1_batch(
+        np.array(p_ids, dtype=np.int32), np.array(p_off, dtype=np.int64),
+        np.array(g_ids, dtype=np.int32), np.array(g_off, dtype=np.int64),
+    ).tolist()
+
+_ABSTAIN = ("", "unknown")
+
+def _no_overlap_answer(pnorm: str, g_tokens) -> bool:
+    """Empty / 'Unknown' answers whose token-F1 against gold is necessarily 0."""
+    return pnorm in _ABSTAIN and pnorm not in g_tokens
+
+def loose_correct_pre(pnorm: str, gnorm: str, thresh: float = 0.6) -> bool:
+    """loose_correct on already-normalized strings; token-F1 only if exact/substring fail."""
+    if pnorm == gnorm:
         return True
-    if g and g in p:
+    if gnorm and gnorm in pnorm:
         return True
-    return token_f1(p, g) >= thresh
+    ps, gs = pnorm.split(), gnorm.split()
+    if _no_overlap_answer(pnorm, gs):
+        return False
+    return token_f1_pre(Counter(ps), Counter(gs), len(ps), len(gs)) >= thresh
+
+def loose_correct(pred: str, gold: str, thresh: float = 0.6) -> bool:
+    # exact match, substring, or token-F1 above threshold
+    return loose_correct_pre(normalize_text(pred), normalize_text(gold), thresh)
+
+# ---------- JSONL I/O ----------
+def iter_jsonl(path: str, bufsize: int = 1 << 20):
+    """Yield parsed records from a JSONL file (large buffered binary reads, blank lines skipped)."""
+    with open(path, "rb", buffering=bufsize) as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
 
 # ---------- Generation cache ----------
-CACHE_PATH = "runs/gen_cache.json"
+CACHE_PATH = "runs/gen_cache.json"            # consolidated snapshot
+CACHE_LOG_PATH = "runs/gen_cache.wal.jsonl"   # WAL: one {"k","a"} line per new answer, replayed on load
 def _load_cache():
+    c = {}
     if os.path.exists(CACHE_PATH):
         with open(CACHE_PATH, "r", encoding="utf-8") as f: 
-            return json.load(f)
-    return {}
-def _save_cache(c):
-    Path("runs").mkdir(parents=True, exist_ok=True)
-    with open(CACHE_PATH, "w", encoding="utf-8") as f:
+            c = json.load(f)
+    if os.path.exists(CACHE_LOG_PATH):
+        with open(CACHE_LOG_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:   # blank or torn last line from an interrupted run
+                    continue
+                c[rec["k"]] = rec["a"]
+    return c
+def _append_cache(wal, entries: dict):
+    # wal: the run's open append-mode handle; flushed per batch so a crash loses at most one batch
+    wal.write(b"".join(orjson.dumps({"k": k, "a": a}) + b"\n" for k, a in entries.items()))
+    wal.flush()
+def _checkpoint_cache(c: dict):
+    """Fold the WAL into the snapshot (atomic replace), then truncate the WAL."""
+    if not os.path.exists(CACHE_LOG_PATH) or os.path.getsize(CACHE_LOG_PATH) == 0:
+        return
+    tmp = CACHE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(c, f)
+    os.replace(tmp, CACHE_PATH)
+    open(CACHE_LOG_PATH, "w").close()
+@lru_cache(maxsize=None)
 def _key(q: str) -> str:
+    # SHA-1 kept: keys are persisted in gen_cache.json, memoized so each question hashes once
     return hashlib.sha1(f"{MODEL_ID}::{q}".encode()).hexdigest()
 
 # ---------- Runner ----------
-def run_eval(bench_path: str, out_dir: str, k: int = 3, limit: int = 0):
-    # Load JSONL
-    bench = []
-    with open(bench_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line: 
-                continue
-            bench.append(json.loads(line))
+def run_eval(bench_path: str, out_dir: str, k: int = 3, limit: int = 0, batch_size: int = 8, workers: int = 8):
+    # Parse JSONL with buffered orjson reads; the bench itself is materialized below,
+    # since batched generation and batched NLI need every example up front
+    bench_iter = iter_jsonl(bench_path)
     if limit:
-        bench = bench[:limit]
+        bench_iter = islice(bench_iter, limit)
 
     Path(out_dir).mkdir(parents=True, exist_ok=True)
     run_tag = time.strftime("%Y%m%d_%H%M%S")
@@ -69,43 +180,82 @@ def run_eval(bench_path: str, out_dir: str, k: int = 3, limit: int = 0):
     label_counts = Counter()
     n_exact = n_loose = n_soft = n = 0
     n_support_hit = 0
-    t_ret = t_ver = 0.0
+    t_ret = t_ver = 0   # integer nanoseconds (perf_counter_ns)
 
     gen_cache = _load_cache()
+    atexit.register(_checkpoint_cache, gen_cache)   # consolidate on shutdown
 
-    with open(jsonl_path, "w", encoding="utf-8") as jf:
-        for idx, ex in enumerate(bench, 1):
+    bench = list(bench_iter)
+
+    # Dedupe on the cache key: each distinct question is generated at most once, then fanned out
+    keys = [_key(ex["question"]) for ex in bench]
+    unique = dict(zip(keys, (ex["question"] for ex in bench)))
+
+    # Generate cache misses up front in batches; each batch is logged to the cache as it lands
+    misses = [q for kq, q in unique.items() if kq not in gen_cache]
+    # vLLM batches continuously, so hand it every miss in one call
+    step = max(len(misses), 1) if MODEL_BACKEND == "vllm" else batch_size
+    if misses:
+        Path(CACHE_LOG_PATH).parent.mkdir(parents=True, exist_ok=True)
+        with open(CACHE_LOG_PATH, "ab") as wal:
+            for i in range(0, len(misses), step):
+                qs = misses[i:i+step]
+                fresh = {_key(q): ans for q, ans in zip(qs, generate_answers(qs, batch_size=batch_size))}
+                gen_cache.update(fresh)
+                _append_cache(wal, fresh)
+    answer_by_key = {kq: gen_cache[kq] for kq in unique}
+
+    # Retrieve concurrently (network-bound); NLI runs once over all items below
+    def _retrieve(q: str, ans: str):
+        t1 = time.perf_counter_ns()
+        evid = retrieve_evidence(q, ans, k=k)
+        return evid, time.perf_counter_ns() - t1
+
+    items = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futs = [pool.submit(_retrieve, ex["question"], answer_by_key[kq]) for ex, kq in zip(bench, keys)]
+        for idx, (ex, kq, fut) in enumerate(zip(bench, keys, futs), 1):
+            evid, dt = fut.result()
+            t_ret += dt
+            items.append((idx, ex, answer_by_key[kq], evid))
+
+    # Verify (batched across all items)
+    t2 = time.perf_counter_ns()
+    verdicts = best_verdict_many(
+        [ex["question"] for _, ex, _, _ in items],
+        [ans for _, _, ans, _ in items],
+        [evid for _, _, _, evid in items],
+    )
+    t_ver += time.perf_counter_ns() - t2
+
+    # normalize pred + gold once per example; loose = exact, substring, or token-F1 >= 0.6,
+    # with token-F1 computed (in one pass) only for rows exact/substring did not decide
+    norms = [(normalize_text(ans), normalize_text(ex.get("gold_answer", ""))) for _, ex, ans, _ in items]
+    looses = [pnorm == gnorm or bool(gnorm and gnorm in pnorm) for pnorm, gnorm in norms]
+    need_f1 = [i for i, hit in enumerate(looses)
+               if not hit and not _no_overlap_answer(norms[i][0], norms[i][1].split())]
+    f1s = token_f1_many([(norms[i][0].split(), norms[i][1].split()) for i in need_f1])
+    for i, f1 in zip(need_f1, f1s):
+        looses[i] = f1 >= 0.6
+
+    with open(jsonl_path, "wb") as jf:
+        buf = []   # serialized records, written in bulk
+        for (idx, ex, ans, evid), verdict, (pnorm, gnorm), is_loose in zip(items, verdicts, norms, looses):
             q     = ex["question"]
             gold  = ex.get("gold_answer", "")
             dom   = ex.get("domain", "")
 
-            # Generate (cached)
-            ck = _key(q)
-            if ck in gen_cache:
-                ans = gen_cache[ck]
-            else:
-                ans = generate_answer(q)
-                gen_cache[ck] = ans
-                _save_cache(gen_cache)
-
-            # Retrieve + Verify
-            t1 = time.time()
-            evid = retrieve_evidence(q, ans, k=k)
-            t2 = time.time()
-            verdict = best_verdict(q, ans, evid)  # << pass question too
-            t3 = time.time()
-
-            exact = int(normalize_text(ans) == normalize_text(gold))
-            loose = int(loose_correct(ans, gold))
+            exact = int(pnorm == gnorm)
+            loose = int(is_loose)
             # Soft correctness: consider "supported" by evidence as soft-correct
             soft  = int(verdict["label"] == "supported")
 
             support_hit = 0
-            gnorm = normalize_text(gold)
-            for s in evid or []:
-                if gnorm and gnorm in normalize_text(s.get("text","")):
-                    support_hit = 1
-                    break
+            if gnorm:
+                for s in evid or []:
+                    if gnorm in _snippet_norm(s):
+                        support_hit = 1
+                        break
 
             n += 1
             n_exact += exact
@@ -114,9 +264,6 @@ def run_eval(bench_path: str, out_dir: str, k: int = 3, limit: int = 0):
             n_support_hit += support_hit
             label_counts[verdict["label"]] += 1
 
-            t_ret += (t2 - t1)
-            t_ver += (t3 - t2)
-
             rec = {
                 "id": ex.get("id", idx),
                 "domain": dom,
@@ -131,18 +278,22 @@ def run_eval(bench_path: str, out_dir: str, k: int = 3, limit: int = 0):
                 "supported_gold_in_evidence": support_hit,
                 "retrieved_titles": [s.get("title") for s in (evid or [])][:5],
             }
-            jf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            buf.append(orjson.dumps(rec) + b"\n")
+            if len(buf) >= 256:
+                jf.write(b"".join(buf))
+                buf.clear()
 
             if idx % 5 == 0:
-                print(f"[{idx}/{len(bench)}] {dom or '—'} | exact={exact} loose={loose} soft={soft} | label={rec['label']}")
+                print(f"[{idx}/{len(items)}] {dom or '—'} | exact={exact} loose={loose} soft={soft} | label={rec['label']}")
+        jf.write(b"".join(buf))
 
     # Aggregate metrics
     exact_acc    = n_exact / max(n, 1)
     loose_acc    = n_loose / max(n, 1)
     soft_acc     = n_soft  / max(n, 1)
     support_rate = n_support_hit / max(n, 1)
-    avg_ret_ms   = (t_ret / max(n, 1)) * 1000
-    avg_ver_ms   = (t_ver / max(n, 1)) * 1000
+    avg_ret_ms   = t_ret / (1e6 * max(n, 1))
+    avg_ver_ms   = t_ver / (1e6 * max(n, 1))
 
     with open(csv_path, "w", newline="", encoding="utf-8") as cf:
         w = csv.writer(cf)
@@ -174,8 +325,10 @@ def main():
     ap.add_argument("--out",   default="runs", help="Output directory")
     ap.add_argument("--k",     type=int, default=3, help="Top-k evidence to retrieve")
     ap.add_argument("--limit", type=int, default=0, help="Evaluate only first N items (debug)")
+    ap.add_argument("--batch-size", type=int, default=8, help="Generation batch size for cache misses")
+    ap.add_argument("--workers", type=int, default=8, help="Threads for concurrent evidence retrieval")
     args = ap.parse_args()
-    run_eval(args.bench, args.out, k=args.k, limit=args.limit)
+    run_eval(args.bench, args.out, k=args.k, limit=args.limit, batch_size=args.batch_size, workers=args.workers)
 
 if __name__ == "__main__":
     main()
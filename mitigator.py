@@ -1,13 +1,13 @@
-from typing import List, Dict
-import os
+from typing import List, Dict, Tuple
+import os, asyncio
+from functools import lru_cache
 from textwrap import shorten
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # OpenAI client (adjust if you use a different SDK)
-from openai import OpenAI
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from openai import AsyncOpenAI
 
 def build_source_block(snippets: List[Dict]) -> str:
     lines = []
@@ -16,10 +16,8 @@ def build_source_block(snippets: List[Dict]) -> str:
         lines.append(f"[S{i}] {txt}")
     return "\n".join(lines)
 
-def regenerate_with_sources(question: str, sources: List[Dict], n: int = 3) -> List[Dict]:
-    """
-    Regenerate an answer constrained to provided sources. Returns a list of dicts [{"text": "..."}].
-    """
+async def aregenerate_with_sources(question: str, sources: List[Dict], n: int = 3) -> List[Dict]:
+    """Async regenerate_with_sources: the n samples are requested concurrently."""
     if not sources:
         # no evidence: return a refusal-style answer
         return [{"text": "Insufficient evidence in the provided sources to answer reliably."}]
@@ -31,13 +29,31 @@ def regenerate_with_sources(question: str, sources: List[Dict], n: int = 3) -> L
     )
     user = f"Question: {question}\n\nSources:\n{src}\n\nAnswer:"
 
-    outs = []
-    for _ in range(n):
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "system", "content": system},
-                      {"role": "user", "content": user}],
-            temperature=0.2
-        )
-        outs.append({"text": resp.choices[0].message.content.strip()})
-    return outs
+    # client per call: its connection pool is bound to the running event loop
+    async with AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY")) as aclient:
+        resps = await asyncio.gather(*(
+            aclient.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "system", "content": system},
+                          {"role": "user", "content": user}],
+                temperature=0.2
+            )
+            for _ in range(n)
+        ))
+    return [{"text": r.choices[0].message.content.strip()} for r in resps]
+
+@lru_cache(maxsize=4096)
+def _regenerate_cached(question: str, texts: Tuple[str, ...], n: int) -> Tuple[str, ...]:
+    # keyed on snippet texts in order: the [S#] citations depend on source order
+    outs = asyncio.run(aregenerate_with_sources(question, [{"text": t} for t in texts], n))
+    return tuple(o["text"] for o in outs)
+
+def regenerate_with_sources(question: str, sources: List[Dict], n: int = 3) -> List[Dict]:
+    """
+    Regenerate an answer constrained to provided sources. Returns a list of dicts [{"text": "..."}].
+    """
+    if not sources:
+        # no evidence: return a refusal-style answer
+        return [{"text": "Insufficient evidence in the provided sources to answer reliably."}]
+    texts = tuple(s.get("text", "") for s in sources)
+    return [{"text": t} for t in _regenerate_cached(question, texts, n)]
@@ -1,28 +1,34 @@
 import os
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from typing import List
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 from huggingface_hub import HfFolder
 import openai 
 
 MODEL_ID = os.getenv("MODEL_ID", "meta-llama/Meta-Llama-3-8B-Instruct")
+# 4-bit NF4 weights (bitsandbytes) for VRAM-bound machines
+LOAD_IN_4BIT = os.getenv("LOAD_IN_4BIT", "0") == "1"
+# "hf" (transformers) or "vllm" (paged KV cache + continuous batching, GPU only)
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "hf")
 
 # Get token from env var or from HF CLI login (~/.huggingface)
 HF_TOKEN = os.getenv("HUGGINGFACE_HUB_TOKEN") or HfFolder.get_token()
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 def _auth_kwargs():
-    import os
     tok = os.getenv("HUGGINGFACE_HUB_TOKEN")
     if tok:
         return {"token": tok}  
     return {}
 
 
-_tokenizer = _model = _gen = None
+_tokenizer = _model = _loaded_id = None
+_PROMPT_PREFIX_IDS = None   # tokenized _PROMPT_PREFIX (with BOS); None -> tokenize full prompts
 
 def _load_hf(model_id: str):
-    global _tokenizer, _model, _gen
-    if _gen is not None and getattr(_gen, "_model_id", None) == model_id:
-        return _gen
+    global _tokenizer, _model, _loaded_id, _PROMPT_PREFIX_IDS
+    if _model is not None and _loaded_id == model_id:
+        return _tokenizer, _model
 
     if "meta-llama/" in model_id and not HF_TOKEN:
         raise RuntimeError(
@@ -36,24 +42,58 @@ def _load_hf(model_id: str):
     _tokenizer = AutoTokenizer.from_pretrained(model_id, **auth)
     if _tokenizer.pad_token is None:
         _tokenizer.pad_token = _tokenizer.eos_token
-
+    _tokenizer.padding_side = "left"   # decoder-only: pad on the left for batched generation
+    # the system prefix is identical for every question: tokenize it once, but only
+    # if prefix ids + suffix ids reproduce the full prompt's ids. Byte-level BPE
+    # (Llama-3, Phi-2) splits cleanly after "\n"; SentencePiece tokenizers (Phi-3,
+    # Mistral, Llama-2) prepend "▁" to standalone text, so they keep full prompts.
+    prefix_ids = _tokenizer(_PROMPT_PREFIX).input_ids
+    probe = "Who wrote Hamlet?"
+    split_ids = prefix_ids + _tokenizer(_question_suffix(probe), add_special_tokens=False).input_ids
+    _PROMPT_PREFIX_IDS = prefix_ids if split_ids == _tokenizer(_build_prompt(probe)).input_ids else None
+
+    # bf16 on GPUs that support it (fp16 otherwise); explicit fp32 on CPU
+    if torch.cuda.is_available():
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    else:
+        dtype = torch.float32
+    quant = {}
+    if LOAD_IN_4BIT and torch.cuda.is_available():
+        quant["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True, bnb_4bit_compute_dtype=dtype, bnb_4bit_quant_type="nf4",
+        )
     _model = AutoModelForCausalLM.from_pretrained(
         model_id,
         device_map="auto",
-        torch_dtype="auto",
+        torch_dtype=dtype,
+        **quant,
         **auth,
     )
-    _gen = pipeline("text-generation", model=_model, tokenizer=_tokenizer, return_full_text=False)
-    _gen._model_id = model_id
-    return _gen
+    _loaded_id = model_id
+    return _tokenizer, _model
+
+_vllm = None
+
+def _load_vllm(model_id: str):
+    global _vllm
+    if _vllm is None:
+        from vllm import LLM  # optional dependency, only needed for MODEL_BACKEND=vllm
+        dtype = "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+        print(f"[models] Loading {model_id} with vLLM | dtype={dtype}")
+        _vllm = LLM(model=model_id, dtype=dtype)
+    return _vllm
+
+_PROMPT_PREFIX = (
+    "You are a concise QA model. "
+    "Answer with ONLY the minimal text span (no punctuation, no extra words). "
+    "If unsure, answer exactly: Unknown.\n"
+)
+
+def _question_suffix(q: str) -> str:
+    return "Q: " + q + "\nA:"
 
 def _build_prompt(q: str) -> str:
-    return (
-        "You are a concise QA model. "
-        "Answer with ONLY the minimal text span (no punctuation, no extra words). "
-        "If unsure, answer exactly: Unknown.\n"
-        f"Q: {q}\nA:"
-    )
+    return _PROMPT_PREFIX + _question_suffix(q)
 
 def generate_answer(question: str, max_new_tokens: int = 16) -> str:
     # OpenAI models
@@ -72,18 +112,49 @@ def generate_answer(question: str, max_new_tokens: int = 16) -> str:
         return ans
 
     # Hugging Face models 
-    gen = _load_hf(MODEL_ID)
-    out = gen(
-        _build_prompt(question),
-        max_new_tokens=max_new_tokens,
-        do_sample=False,
-        pad_token_id=gen.tokenizer.pad_token_id,
-    )[0]["generated_text"]
-    ans = out.splitlines()[0]
+    return generate_answers([question], max_new_tokens=max_new_tokens, batch_size=1)[0]
+
+def _clean_hf_answer(out: str) -> str:
+    ans = (out.splitlines() or [""])[0]
     ans = ans.replace("Answer:", "").replace("A:", "").strip()
     ans = ans.strip(" .,:;!?\"'()[]{}")
     return ans
 
-
-
-
+def generate_answers(questions: List[str], max_new_tokens: int = 16, batch_size: int = 8) -> List[str]:
+    """Batched generate_answer; HF models generate batch_size prompts per forward pass."""
+    if MODEL_ID.startswith("gpt-"):
+        return [generate_answer(q, max_new_tokens=max_new_tokens) for q in questions]
+
+    if MODEL_BACKEND == "vllm":
+        from vllm import SamplingParams
+        # vLLM schedules its own batches; batch_size is ignored
+        llm = _load_vllm(MODEL_ID)
+        outs = llm.generate([_build_prompt(q) for q in questions],
+                            SamplingParams(temperature=0, max_tokens=max_new_tokens))
+        return [_clean_hf_answer(o.outputs[0].text) for o in outs]
+
+    # direct model.generate (greedy, KV cache); no pipeline plumbing per call
+    tok, model = _load_hf(MODEL_ID)
+    answers = []
+    for i in range(0, len(questions), batch_size):
+        batch = questions[i:i+batch_size]
+        if _PROMPT_PREFIX_IDS is not None:
+            # only the per-question suffix is tokenized; the cached prefix ids are prepended
+            suffixes = tok([_question_suffix(q) for q in batch], add_special_tokens=False).input_ids
+            enc = tok.pad({"input_ids": [_PROMPT_PREFIX_IDS + ids for ids in suffixes]},
+                          return_tensors="pt").to(model.device)
+        else:
+            enc = tok([_build_prompt(q) for q in batch], return_tensors="pt",
+                      padding=True, truncation=True).to(model.device)
+        with torch.inference_mode():
+            out = model.generate(
+                **enc,
+                use_cache=True,
+                do_sample=False,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=tok.pad_token_id,
+            )
+        # left padding -> every row's prompt ends at the same column
+        new_tokens = out[:, enc["input_ids"].shape[1]:]
+        answers.extend(_clean_hf_answer(t) for t in tok.batch_decode(new_tokens, skip_special_tokens=True))
+    return answers